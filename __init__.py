@@ -16,14 +16,20 @@
 #You should have received a copy of the GNU General Public License
 #along with TRI Tools. If not, see <https://www.gnu.org/licenses/>.
 
-import bpy
+try:
+    import bpy
+except ImportError:
+    #We are imported outside of Blender, by an import worker process or the scanner.
+    #Only the modules that don't depend on bpy (trifile, cache, scan) are usable.
+    bpy = None
 
-if bpy.app.version[0] == 2 and bpy.app.version[1] < 80:
-    import tri_tools.ops_2_79 as ops
-    import tri_tools.ui_2_79 as ui
-else:
-    import tri_tools.ops as ops
-    import tri_tools.ui as ui
+if bpy is not None:
+    if bpy.app.version[0] == 2 and bpy.app.version[1] < 80:
+        import tri_tools.ops_2_79 as ops
+        import tri_tools.ui_2_79 as ui
+    else:
+        import tri_tools.ops as ops
+        import tri_tools.ui as ui
 
 bl_info = {
     'name': "TRI Tools",
@@ -0,0 +1,244 @@
+"""On-disk cache of decoded TRI files (and other arrays), without Blender dependencies"""
+
+#Copyright 2022 Jonas Gernandt
+#
+#This file is part of TRI Tools, a Blender addon for working with 
+#Skyrim face morphs.
+#
+#TRI Tools is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#TRI Tools is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with TRI Tools. If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from tri_tools.trifile import F32, TriData, TriFile, match_patterns
+
+#An entry is a header (signature, version, length of index), a JSON index, and then the arrays
+#at aligned offsets. The arrays are mapped directly from the file when loaded.
+SIGNATURE = b"TRICACHE"
+VERSION = 3
+HEADER = struct.Struct("<8sIQ")
+ALIGNMENT = 64
+
+FILE_EXT = ".tricache"
+
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), "tri_tools_cache")
+
+#Total size of the cache, beyond which the least recently used entries are removed
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+
+def get_key(path, patterns=(), matrix=None):
+    """Identifies the decoded contents of a file, as long as its size and time of modification are unchanged"""
+    stat = os.stat(path)
+    h = hashlib.sha1()
+    h.update(os.path.abspath(path).encode())
+    h.update(struct.pack("<qq", stat.st_size, stat.st_mtime_ns))
+    h.update(",".join(patterns).encode())
+    if matrix is not None:
+        h.update(np.array(matrix, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def content_hash(*items):
+    """A hash of arrays, strings and bytes, to recognise data that hasn't changed"""
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item, str):
+            item = item.encode()
+        elif not isinstance(item, bytes):
+            #hash the array's own memory, without copying it to bytes
+            item = memoryview(np.ascontiguousarray(item)).cast("B")
+        h.update(struct.pack("<Q", len(item)))
+        h.update(item)
+    return h.digest()
+
+
+def decode_tri_cached(path, patterns=(), matrix=None, directory=DEFAULT_DIRECTORY):
+    """Like trifile.decode_tri, but returns the cached result if there is one, or else caches the result"""
+    entry = os.path.join(directory, get_key(path, patterns, matrix) + FILE_EXT)
+    
+    data = load(entry)
+    if data is None:
+        with TriFile(path) as tri:
+            index, arrays = read(tri, patterns, None if matrix is None else np.array(matrix, dtype=np.float64))
+        data = unpack(index, arrays)
+        try:
+            store_arrays(entry, index, sorted(arrays.items()))
+        except OSError:
+            #caching is an optimisation, don't fail the import because of it
+            pass
+    
+    return data
+
+
+def load(entry):
+    """Map a cache entry of a decoded file. Returns None if it doesn't exist or is not valid."""
+    loaded = load_arrays(entry)
+    if loaded is None:
+        return None
+    
+    try:
+        return unpack(*loaded)
+    except (KeyError, TypeError):
+        return None
+
+
+def read(tri, patterns=(), matrix=None):
+    """The index and arrays of a cache entry of an open TriFile, as decoded with the 3x3 matrix (if given).
+    
+    The positions of each kind of morph are decoded into one (morphs, V, 3) array, 
+    so that loading them is only a matter of mapping the entry."""
+    vertices = tri.transformed_vertices(matrix)
+    
+    diff_morphs = [(i, info.name) for i, info in enumerate(tri.diff_morphs) if match_patterns(info.name, patterns)]
+    diff_co = np.empty((len(diff_morphs), tri.V, 3), dtype=F32)
+    for j, (i, _) in enumerate(diff_morphs):
+        tri.diff_morph_positions(i, vertices, matrix, diff_co[j])
+    
+    stat_morphs = [(i, info.name) for i, info in enumerate(tri.stat_morphs) if match_patterns(info.name, patterns)]
+    stat_co = np.empty((len(stat_morphs), tri.V, 3), dtype=F32)
+    for j, (i, _) in enumerate(stat_morphs):
+        tri.stat_morph_positions(i, vertices, matrix, stat_co[j])
+    
+    arrays = {
+        "vertices": vertices,
+        "tris": np.array(tri.tris),
+        "quads": np.array(tri.quads),
+        "diff_morphs": diff_co,
+        "stat_morphs": stat_co}
+    uvs = tri.loop_uvs()
+    if uvs is not None:
+        arrays["uvs"] = uvs
+    
+    index = {
+        "path": tri.path,
+        "diff_morphs": [name for _, name in diff_morphs],
+        "stat_morphs": [name for _, name in stat_morphs],
+        "morph_count": tri.Md + tri.Ms,
+        "has_labels": tri.LV > 0 or tri.LS > 0}
+    
+    return index, arrays
+
+
+def unpack(index, arrays):
+    """A TriData of the index and arrays of a cache entry. Its arrays refer to those of the entry."""
+    return TriData(
+        path=index["path"],
+        vertices=arrays["vertices"],
+        tris=arrays["tris"],
+        quads=arrays["quads"],
+        uvs=arrays.get("uvs"),
+        diff_morphs=list(zip(index["diff_morphs"], arrays["diff_morphs"])),
+        stat_morphs=list(zip(index["stat_morphs"], arrays["stat_morphs"])),
+        morph_count=index["morph_count"],
+        has_labels=index["has_labels"])
+
+
+def load_arrays(entry):
+    """Map a cache entry. Returns its index (a dict) and a dict of its arrays, or None if it doesn't exist 
+    or is not valid.
+    
+    The arrays refer directly to the mapped file. It stays mapped (and on Windows, can't be evicted) 
+    until they are all released."""
+    try:
+        with open(entry, "rb") as file:
+            m = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        #mark as recently used
+        os.utime(entry)
+    except (OSError, ValueError):
+        return None
+    
+    try:
+        signature, version, N = HEADER.unpack_from(m, 0)
+        if signature != SIGNATURE or version != VERSION:
+            return None
+        index = json.loads(m[HEADER.size:HEADER.size + N].decode())
+        base = align(HEADER.size + N)
+        
+        arrays = {}
+        for name, dtype, shape, offset in index.pop("arrays"):
+            arrays[name] = np.frombuffer(m, dtype=dtype, count=int(np.prod(shape)), offset=base + offset).reshape(shape)
+        
+        return index, arrays
+    
+    except (struct.error, ValueError, KeyError, TypeError):
+        return None
+
+
+def store_arrays(entry, index, arrays):
+    """Write a cache entry of an index (a JSON-serialisable dict) and a list of (name, array)"""
+    index = dict(index, arrays=[])
+    
+    #offsets are relative to the end of the index
+    size = 0
+    for name, array in arrays:
+        index["arrays"].append((name, array.dtype.str, array.shape, size))
+        size = align(size + array.nbytes)
+    encoded = json.dumps(index).encode()
+    base = align(HEADER.size + len(encoded))
+    
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    
+    #write to a temporary file and move it into place, in case someone else is reading or writing the same entry
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry))
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(HEADER.pack(SIGNATURE, VERSION, len(encoded)))
+            file.write(encoded)
+            for (name, array), (_, _, _, offset) in zip(arrays, index["arrays"]):
+                file.write(bytes(base + offset - file.tell()))
+                file.write(np.ascontiguousarray(array).tobytes())
+            #pad the end, so that the offset of an empty array is within the file
+            file.write(bytes(base + size - file.tell()))
+        os.replace(tmp, entry)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def evict(directory=DEFAULT_DIRECTORY, max_size=DEFAULT_MAX_SIZE):
+    """Remove the least recently used entries until the cache is no larger than max_size"""
+    try:
+        entries = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(FILE_EXT)]
+    except OSError:
+        return
+    
+    stats = []
+    for entry in entries:
+        try:
+            stats.append((os.stat(entry), entry))
+        except OSError:
+            pass
+    
+    total = sum(st.st_size for st, _ in stats)
+    for st, entry in sorted(stats, key=lambda e: e[0].st_mtime):
+        if total <= max_size:
+            break
+        try:
+            os.remove(entry)
+            total -= st.st_size
+        except OSError:
+            #probably in use (on Windows, a mapped entry can't be removed), leave it for next time
+            pass
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
@@ -18,93 +18,346 @@
 #You should have received a copy of the GNU General Public License
 #along with TRI Tools. If not, see <https://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
+import functools
+import itertools
+import multiprocessing
 import os
 import struct
+import threading
 
 import bpy
 import mathutils
 import bpy_extras
+import numpy as np
 
-SIGNATURE = b"FRTRI003"
+import tri_tools.cache
+from tri_tools.trifile import (HEADER, SIGNATURE, F32, I16, I32, TriStream, decode_tri, encode_diff_morph, encode_label,
+    encode_stat_morph, parse_patterns, quantize_deltas)
 
 IS_2_79 = bpy.app.version[0] == 2 and bpy.app.version[1] < 80
 
+#Everything we export from a mesh object, read on the main thread.
+#shapes is a list of (name, label in file, is absolute, coordinates), excluding the reference key.
+ExportData = collections.namedtuple("ExportData",
+    ["name", "vertices", "loop_start", "loop_total", "loop_verts", "loop_uvs", "ref_co", "shapes"])
+
+#Export settings, taken from the operator so that encoding doesn't need it
+ExportSettings = collections.namedtuple("ExportSettings", ["uv_format", "basis", "stat_morph_epsilon", "use_cache"])
+
+#Encoded morphs from the last export of the most recently exported objects, by hash of their data and 
+#the export settings, and their total size. Objects that are deleted or renamed eventually drop out.
+export_cache = collections.OrderedDict()
+export_cache_lock = threading.Lock()
+MAX_EXPORT_CACHE_SIZE = 256 * 1024 * 1024
+
 def export_tri(op, mesh):
+    data = gather_export_data(op, mesh)
+    
+    #Morphs are encoded in parallel
+    threads = get_thread_count(op)
+    if threads > 1 and len(data.shapes) > 1:
+        with concurrent.futures.ThreadPoolExecutor(min(threads, len(data.shapes))) as pool:
+            blocks, messages = encode_tri(data, get_export_settings(op), pool)
+    else:
+        blocks, messages = encode_tri(data, get_export_settings(op))
+    
+    for message in messages:
+        op.report(*message)
+    
+    write_tri(op.filepath, blocks)
+    
+    op.report({'INFO'}, op.filepath + " exported successfully")
+
+
+def export_tri_batch(op, context):
+    """Export every selected mesh to its own file, named by op.filename_template"""
+    objects = [obj for obj in context.selected_objects if obj.type == 'MESH']
+    if len(objects) == 0:
+        raise RuntimeError("No selected meshes")
+    
+    settings = get_export_settings(op)
+    directory = os.path.dirname(op.filepath)
+    threads = get_thread_count(op)
+    
+    #Name all files before encoding anything, so that a bad template doesn't leave a partial export
+    paths = [os.path.join(directory, get_export_filename(op.filename_template, obj)) for obj in objects]
+    named = {}
+    for obj, path in zip(objects, paths):
+        other = named.setdefault(os.path.normcase(path), obj)
+        if other is not obj:
+            raise RuntimeError("%s and %s would both be exported to %s" % (other.name, obj.name, path))
+    
+    #Data is read from Blender here, and encoded by the pool (numpy mostly releases the GIL).
+    #Then each file is written as soon as it is done, while the pool encodes the rest.
+    jobs = []
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        for obj, path in zip(objects, paths):
+            try:
+                jobs.append((path, pool.submit(encode_tri, gather_export_data(op, obj), settings)))
+            except RuntimeError as e:
+                op.report({'ERROR'}, "%s: %s" % (obj.name, str(e)))
+        
+        for path, job in jobs:
+            try:
+                blocks, messages = job.result()
+            except RuntimeError as e:
+                op.report({'ERROR'}, "%s: %s" % (path, str(e)))
+                continue
+            
+            for message in messages:
+                op.report(*message)
+            
+            write_tri(path, blocks)
+            
+            op.report({'INFO'}, path + " exported successfully")
+
+
+def export_tri_streaming(op, mesh):
+    """Export one shape key at a time, so that memory use doesn't grow with the number of morphs"""
+    data = gather_export_data(op, mesh, shapes=False)
+    settings = get_export_settings(op)
+    basis = settings.basis
+    epsilon = settings.stat_morph_epsilon
+    
+    counts, geometry = encode_geometry(data, settings)
+    V = counts[0]
+    
+    rel_shapes = []
+    abs_shapes = []
+    ref_co = None
+    if mesh.data.shape_keys != None:
+        ref_co = get_array(mesh.data.shape_keys.reference_key.data, "co", F32, 3)
+        
+        for shape in mesh.data.shape_keys.key_blocks:
+            if shape != mesh.data.shape_keys.reference_key:
+                (abs_shapes if is_abs_morph(shape) else rel_shapes).append(shape)
+    
+    #Every shape key is read into, and encoded in, these
+    co = np.empty((V, 3), dtype=F32)
+    scratch = np.empty((V, 3), dtype=np.float64)
+    quantized = np.empty((V, 3), dtype=I16)
+    
+    def read(shape):
+        shape.data.foreach_get("co", co.ravel())
+        return co
+    
+    #The header needs the number of morph targets, so count them first
+    K = sum(len(get_morphed_vertices(read(shape), ref_co, epsilon)) for shape in abs_shapes)
+    
+    with open(op.filepath, "wb") as file:
+        file.write(HEADER.pack(SIGNATURE, *counts, len(rel_shapes), len(abs_shapes), K, bytes(16)))
+        
+        #Vertices and morph targets
+        file.write(geometry[0])
+        for shape in abs_shapes:
+            vtx_ind = get_morphed_vertices(read(shape), ref_co, epsilon)
+            file.write(transform(co[vtx_ind], basis))
+        
+        #Faces and UVs
+        for block in geometry[1:]:
+            file.write(block)
+        
+        #Diff morphs (same as encode_rel_morph, but in place)
+        for shape in rel_shapes:
+            np.subtract(read(shape), ref_co, out=co)
+            np.matmul(co, basis.T, out=scratch)
+            co[:] = scratch
+            
+            scale, _ = quantize_deltas(co, scratch, quantized)
+            if not co.any():
+                op.report({'INFO'}, "Shape %s is identical to reference" % shape.name)
+            
+            file.write(encode_label(get_shape_name(shape)))
+            file.write(struct.pack("<f", scale))
+            file.write(quantized)
+        
+        #Stat morphs
+        for shape in abs_shapes:
+            vtx_ind = get_morphed_vertices(read(shape), ref_co, epsilon)
+            file.write(encode_stat_morph(get_shape_name(shape), vtx_ind))
+    
+    op.report({'INFO'}, op.filepath + " exported successfully")
+
+
+def gather_export_data(op, mesh, shapes=True):
+    """Read everything we export from a mesh object (but its shape keys, unless shapes)"""
     if mesh.matrix_world != mathutils.Matrix.Identity(4):
-        op.report({'WARNING'}, "Object's world-space transform is not exported")
+        op.report({'WARNING'}, "%s: Object's world-space transform is not exported" % mesh.name)
     
-    #Gather data and validate export settings
+    if op.uv_format != 'UV_NONE':
+        if mesh.data.uv_layers.active == None:
+            raise RuntimeError("Add a UV Map or choose UV Format: None.")
+        loop_uvs = get_array(mesh.data.uv_layers.active.data, "uv", F32, 2)
+    else:
+        loop_uvs = None
     
-    basis = bpy_extras.io_utils.axis_conversion(
-        from_forward='-Y', 
-        from_up='Z', 
-        to_forward=op.axis_forward, 
-        to_up=op.axis_up).to_4x4()
+    ref_co = None
+    shape_data = []
+    if shapes and mesh.data.shape_keys != None:
+        ref_co = get_array(mesh.data.shape_keys.reference_key.data, "co", F32, 3)
+        
+        for shape in mesh.data.shape_keys.key_blocks:
+            if shape == mesh.data.shape_keys.reference_key:
+                continue
+            shape_data.append((shape.name, get_shape_name(shape), is_abs_morph(shape), get_array(shape.data, "co", F32, 3)))
+    
+    return ExportData(
+        name=mesh.name,
+        vertices=get_array(mesh.data.vertices, "co", F32, 3),
+        loop_start=get_array(mesh.data.polygons, "loop_start", I32),
+        loop_total=get_array(mesh.data.polygons, "loop_total", I32),
+        loop_verts=get_array(mesh.data.loops, "vertex_index", I32),
+        loop_uvs=loop_uvs,
+        ref_co=ref_co,
+        shapes=shape_data)
+
+
+def encode_tri(data, settings, pool=None):
+    """Encode an ExportData. Returns the blocks (bytes or arrays) that make up the file, and messages to report.
     
-    V = len(mesh.data.vertices)
+    This doesn't touch Blender data, so it can run in any thread. If a pool (an Executor) is given, 
+    morphs are encoded by it."""
+    messages = []
     
-    tris = []
-    quads = []
-    for f in mesh.data.polygons:
-        if len(f.vertices) == 3:
-            tris.append(f)
-        elif len(f.vertices) == 4:
-            quads.append(f)
-        else:
-            raise RuntimeError("Only tris and quads are supported")
+    basis = settings.basis
+    
+    counts, geometry = encode_geometry(data, settings)
+    
+    #encoded morphs, reused from the last export of this object if neither they nor the settings have changed
+    with export_cache_lock:
+        cache = export_cache.pop(data.name, ({}, 0))[0]
+    if not settings.use_cache:
+        cache = {}
+    new_cache = {}
+    
+    #(encoded morph, transformed targets)
+    abs_morphs = []
+    #(encoded morph, is empty)
+    rel_morphs = []
+    
+    if len(data.shapes) > 0:
+        #calc deltas to ref key (or base mesh? Not necessarily the same!)
+        ref_co = data.ref_co
+        #(hashing is not free, only do it if we will reuse anything)
+        if settings.use_cache:
+            settings_hash = tri_tools.cache.content_hash(basis, ref_co, settings.stat_morph_epsilon)
+        
+        def encode_morph(shape):
+            name, label, is_abs, co = shape
+            key = tri_tools.cache.content_hash(settings_hash, name, co) if settings.use_cache else None
+            
+            morph = cache.get(key)
+            if morph is None:
+                if is_abs:
+                    morph = encode_abs_morph(label, co, ref_co, basis, settings.stat_morph_epsilon)
+                else:
+                    morph = encode_rel_morph(label, co, ref_co, basis)
+            
+            return key, morph
+        
+        #Results come back in order, so the file is the same however many threads we use
+        results = pool.map(encode_morph, data.shapes) if pool else map(encode_morph, data.shapes)
+        
+        for (name, _, is_abs, _), (key, morph) in zip(data.shapes, results):
+            if is_abs:
+                abs_morphs.append(morph)
+            else:
+                rel_morphs.append(morph)
+                
+                if morph[1]:
+                    messages.append(({'INFO'}, "Shape %s is identical to reference" % name))
+            
+            new_cache[key] = morph
+    
+    if settings.use_cache:
+        #the encoded morph, and the targets of stat morphs
+        size = sum(len(morph[0]) + getattr(morph[1], "nbytes", 0) for morph in new_cache.values())
+        with export_cache_lock:
+            export_cache[data.name] = (new_cache, size)
+            while sum(entry[1] for entry in export_cache.values()) > MAX_EXPORT_CACHE_SIZE:
+                export_cache.popitem(last=False)
+    
+    Md = len(rel_morphs)
+    Ms = len(abs_morphs)
+    K = sum(len(targets) for _, targets in abs_morphs)
+    
+    #The file is assembled as a list of blocks (bytes or arrays)
+    blocks = []
+    
+    #Header
+    blocks.append(HEADER.pack(SIGNATURE, *counts, Md, Ms, K, bytes(16)))
+    
+    #Vertices and morph targets
+    blocks.append(geometry[0])
+    for _, targets in abs_morphs:
+        blocks.append(targets)
+    
+    #Faces and UVs
+    blocks.extend(geometry[1:])
+    
+    #Diff morphs
+    for morph, _ in rel_morphs:
+        blocks.append(morph)
+    
+    #Stat morphs
+    for morph, _ in abs_morphs:
+        blocks.append(morph)
+    
+    return blocks, messages
+
+
+def encode_geometry(data, settings):
+    """Encode everything but the morphs of an ExportData.
+    
+    Returns the counts of the header up to the morphs (V, T, Q, LV, LS, X, ext), and the blocks of 
+    the vertices followed by those of the faces and UVs."""
+    V = len(data.vertices)
+    
+    #Faces, as indices of their loops (and then vertices)
+    tri_loops, quad_loops = get_face_loops(data.loop_start, data.loop_total)
+    
+    loop_verts = data.loop_verts
+    tris = loop_verts[tri_loops]
+    quads = loop_verts[quad_loops]
     
     T = len(tris)
     Q = len(quads)
     LV = 0
     LS = 0
     
-    if op.uv_format == 'UV_VERTEX':
-        if mesh.data.uv_layers.active == None:
-            raise RuntimeError("Add a UV Map or choose UV Format: None.")
+    if settings.uv_format == 'UV_VERTEX':
+        #the uv coords to export, as one 64-bit key per loop so that we can compare them exactly
+        loop_uvs = data.loop_uvs
+        keys = loop_uvs.view(np.uint64).ravel()
         
-        #the uv coords to export
-        uvs = [0] * len(mesh.data.vertices)
-        #a temp set of vertices we have passed
-        passed = set()
+        uvs = np.zeros((V, 2), dtype=F32)
+        uvs[loop_verts] = loop_uvs
         
-        for i, loop in enumerate(mesh.data.uv_layers.active.data):
-            uv = struct.pack("<ff", loop.uv[0], loop.uv[1])
-            vertex_index = mesh.data.loops[i].vertex_index
-            #If we have already passed this vertex, its uv must be the same. Else there's a seam.
-            if vertex_index in passed:
-                if uvs[vertex_index] != uv:
-                    raise RuntimeError("Mesh has UV seams. Choose another UV Format.")
-            else:
-                passed.add(vertex_index)
-                uvs[vertex_index] = uv
-        
-        del passed
+        #All loops of a vertex must have the same uv. Else there's a seam.
+        seams = np.unique(loop_verts[keys != uvs.view(np.uint64).ravel()[loop_verts]])
+        if len(seams) > 0:
+            raise RuntimeError("Mesh has UV seams (at vertices %s%s). Choose another UV Format." % (
+                ", ".join(str(i) for i in seams[:10]), ", ..." if len(seams) > 10 else ""))
         
         X = 0
         ext = 1
-    elif op.uv_format == 'UV_FACE':
-        if mesh.data.uv_layers.active == None:
-            raise RuntimeError("Add a UV Map or choose UV Format: None.")
-        
-        #the uv coords to export
-        uvs = []
-        #loop indices into the list of uvs
-        li = [-1] * len(mesh.data.loops)
-        #a temp map of uv -> index in file
-        used_map = {}
+    elif settings.uv_format == 'UV_FACE':
+        loop_uvs = data.loop_uvs
+        keys = loop_uvs.view(np.uint64).ravel()
         
         #We don't want to store duplicate UV coords. We could, but let's do this right.
-        #This will filter them out.
-        for i, loop in enumerate(mesh.data.uv_layers.active.data):
-            uv = struct.pack("<ff", loop.uv[0], loop.uv[1])
-            if uv in used_map:
-                li[i] = used_map[uv]
-            else:
-                li[i] = len(uvs)
-                used_map[uv] = len(uvs)
-                uvs.append(uv)
+        #This will filter them out, and number the rest in order of first appearance.
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty(len(order), dtype=I32)
+        rank[order] = np.arange(len(order), dtype=I32)
         
-        del used_map
+        #the uv coords to export
+        uvs = loop_uvs[first[order]]
+        #loop indices into the list of uvs
+        li = rank[inverse.ravel()]
         
         X = len(uvs)
         ext = 1
@@ -113,210 +366,308 @@ def export_tri(op, mesh):
         X = 0
         ext = 0
     
-    abs_morphs = []
-    abs_morph_verts = []
-    rel_morphs = []
-    morph_targets = []
+    blocks = []
     
-    if mesh.data.shape_keys != None:
-        for shape in mesh.data.shape_keys.key_blocks:
-            if shape == mesh.data.shape_keys.reference_key:
-                continue
-            
-            if is_abs_morph(shape):
-                #Find all morphed vertices. They are our targets.
-                vtx_ind_list = []
-                for i in range(V):
-                    if shape.data[i].co != mesh.data.shape_keys.reference_key.data[i].co:
-                        morph_targets.append(shape.data[i].co)
-                        vtx_ind_list.append(i)
-                
-                abs_morphs.append(shape)
-                abs_morph_verts.append(vtx_ind_list)
-                
-            else:
-                rel_morphs.append(shape)
+    #Vertices
+    blocks.append(transform(data.vertices, settings.basis))
     
-    Md = len(rel_morphs)
-    Ms = len(abs_morphs)
-    K = len(morph_targets)
+    #Faces
+    blocks.append(tris)
+    blocks.append(quads)
     
-    #Start export
-    with open(op.filepath, "wb") as file:
-        
-        #Header
-        file.write(struct.pack("<8s10i16s", SIGNATURE, V, T, Q, LV, LS, X, ext, Md, Ms, K, bytes(16)))
-        
-        #Vertices and morph targets
-        if IS_2_79:
-            for v in mesh.data.vertices:
-                file.write(pack_vector3(basis * (op.length_scale * v.co)))
-            for r in morph_targets:
-                file.write(pack_vector3(basis * (op.length_scale * r)))
-        else:
-            for v in mesh.data.vertices:
-                file.write(pack_vector3(basis @ (op.length_scale * v.co)))
-            for r in morph_targets:
-                file.write(pack_vector3(basis @ (op.length_scale * r)))
-        
-        #Faces
-        for f in tris:
-            file.write(struct.pack("<3i", f.vertices[0], f.vertices[1], f.vertices[2]))
-        for f in quads:
-            file.write(struct.pack("<4i", f.vertices[0], f.vertices[1], f.vertices[2], f.vertices[3]))
-        
-        #We don't support labels
-        
-        #UVs
-        if op.uv_format == 'UV_VERTEX':
-            file.write(bytes(0).join(uvs))
-        elif op.uv_format == 'UV_FACE':
-            file.write(bytes(0).join(uvs))
-            for f in tris:
-                file.write(struct.pack("<3i", li[f.loop_indices[0]], li[f.loop_indices[1]], li[f.loop_indices[2]]))
-            for f in quads:
-                file.write(struct.pack("<4i", li[f.loop_indices[0]], li[f.loop_indices[1]], li[f.loop_indices[2]], li[f.loop_indices[3]]))
+    #We don't support labels
+    
+    #UVs
+    if settings.uv_format == 'UV_VERTEX':
+        blocks.append(uvs)
+    elif settings.uv_format == 'UV_FACE':
+        blocks.append(uvs)
+        blocks.append(li[tri_loops])
+        blocks.append(li[quad_loops])
+    
+    return (V, T, Q, LV, LS, X, ext), blocks
+
+
+def write_tri(path, blocks):
+    #One allocation, one write
+    with open(path, "wb") as file:
+        file.write(bytes(0).join(blocks))
+
+
+def import_tri(op, context):
+    paths = get_import_paths(op)
+    if len(paths) == 0:
+        raise RuntimeError("No TRI files found")
+    
+    patterns = parse_patterns(op.morph_filter)
+    
+    #User transforms are applied to the data as it is decoded
+    matrix = [list(row) for row in get_import_matrix(op)]
+    if op.use_cache:
+        decode = functools.partial(tri_tools.cache.decode_tri_cached, patterns=patterns, matrix=matrix)
+    else:
+        decode = functools.partial(decode_tri, patterns=patterns, matrix=matrix)
+    
+    if op.update_active:
+        #Morphs go to the active object, no new objects
+        target = context.active_object
+        if target == None or target.type != 'MESH':
+            raise RuntimeError("No active mesh")
+        if len(paths) > 1:
+            raise RuntimeError("Only one file can be imported into the active object")
+        
+        create = functools.partial(update_object, mesh=target)
+    else:
+        create = create_object
         
-        #Diff morphs
-        for shape in rel_morphs:
-            ref = mesh.data.shape_keys.reference_key
-                
-            #calc deltas to ref key (or base mesh? Not necessarily the same!)
+        #Deselect everything, we'll select what we import
+        for obj in context.selected_objects:
             if IS_2_79:
-                deltas = [basis * (op.length_scale * (shape.data[i].co - ref.data[i].co)) for i in range(V)]
-            else:
-                deltas = [basis @ (op.length_scale * (shape.data[i].co - ref.data[i].co)) for i in range(V)]
-            
-            #choose the scale so that the largest component in any delta vector equals the largest short int
-            delta_max = max([max([abs(d[0]), abs(d[1]), abs(d[2])]) for d in deltas])
-            
-            if delta_max == 0.0:
-                op.report({'INFO'}, "Shape %s is identical to reference" % shape.name)
-                scale = 1.0
+                obj.select = False
             else:
-                scale = delta_max / 32767
-            
-            write_morph_label(file, shape)
-            
-            file.write(struct.pack("<f", scale))
-            for d in deltas:
-                file.write(struct.pack("<3h", round(d[0] / scale), round(d[1] / scale), round(d[2] / scale)))
-        
-        #Stat morphs
-        for shape, vtx_ind_list in zip(abs_morphs, abs_morph_verts):
-            write_morph_label(file, shape)
-            file.write(len(vtx_ind_list).to_bytes(4, byteorder="little", signed=True))
-            for i in vtx_ind_list:
-                file.write(i.to_bytes(4, byteorder="little", signed=True))
-        
-        op.report({'INFO'}, op.filepath + " exported successfully")
+                obj.select_set(False)
+    
+    workers = min(op.workers if op.workers > 0 else os.cpu_count() or 1, len(paths))
+    
+    if op.low_memory:
+        #One file, and one morph, at a time
+        with TriStream(paths, patterns, matrix) as stream:
+            create_objects(op, context, paths, stream, create)
+    
+    #Before 2.91, sys.executable is Blender itself and can't run the worker processes
+    elif workers > 1 and bpy.app.version >= (2, 91, 0):
+        #Files are decoded in worker processes, in order, while we build the objects here.
+        #Spawn, don't fork, the workers have no use for a copy of Blender.
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            #Only a few files ahead of us, or decoded files would pile up faster than we create their objects
+            futures = submit_ahead(pool, decode, paths, 2 * workers)
+            create_objects(op, context, paths, map(concurrent.futures.Future.result, futures), create)
+    else:
+        create_objects(op, context, paths, map(decode, paths), create)
+    
+    if op.use_cache:
+        tri_tools.cache.evict()
 
 
-def import_tri(op, context):
-    with open(op.filepath, "rb") as file:
-        
-        #Check validity of file and read header data
-        if file.read(8) != SIGNATURE:
-            raise RuntimeError("Not a FaceGen TRI file")
-        V, T, Q, LV, LS, X, ext, Md, Ms, K, _ = struct.unpack("<10i16s", file.read(56))
-        
-        #Warn about discarded data (we can't reproduce labels within Blender, I think)
-        if LV > 0 or LS > 0:
-            op.report({'WARNING'}, "Labels were discarded")
-        
-        #Create and activate new mesh
-        name = os.path.splitext(os.path.basename(op.filepath))[0]
-        mesh_data = context.blend_data.meshes.new(name)
-        mesh = context.blend_data.objects.new(name, mesh_data)
-        
-        bpy.ops.object.select_all(action='DESELECT')
-        
+def submit_ahead(pool, fn, items, window):
+    """Submit fn(item) for every item to pool, and yield their futures in order.
+    
+    At most window items are submitted ahead of the future last yielded."""
+    items = iter(items)
+    pending = collections.deque(pool.submit(fn, item) for item in itertools.islice(items, window))
+    while len(pending) > 0:
+        future = pending.popleft()
+        for item in itertools.islice(items, 1):
+            pending.append(pool.submit(fn, item))
+        yield future
+
+
+def create_objects(op, context, paths, results, create=None):
+    """Create an object for each decoded file in results (by create, create_object by default). Returns the objects."""
+    create = create or create_object
+    imported = []
+    
+    for path in paths:
+        try:
+            data = next(results)
+            imported.append(create(op, context, data))
+        except (RuntimeError, OSError) as e:
+            #If we are importing several files, skip the broken (or missing) ones
+            if len(paths) == 1:
+                raise
+            op.report({'ERROR'}, "%s: %s" % (path, str(e)))
+    
+    return imported
+
+
+def create_object(op, context, data):
+    """Create a new mesh object from a TriData"""
+    
+    #Warn about discarded data (we can't reproduce labels within Blender, I think)
+    if data.has_labels:
+        op.report({'WARNING'}, "Labels were discarded")
+    
+    #Create and activate new mesh
+    name = os.path.splitext(os.path.basename(data.path))[0]
+    mesh_data = context.blend_data.meshes.new(name)
+    mesh = context.blend_data.objects.new(name, mesh_data)
+    
+    if IS_2_79:
+        context.scene.objects.link(mesh)
+        mesh.select = True
+        context.scene.objects.active = mesh
+    else:
+        context.collection.objects.link(mesh)
+        mesh.select_set(True)
+        context.view_layer.objects.active = mesh
+    
+    
+    #Start import (in case of corrupt data, delete the mesh and cancel import)
+    try:
+        set_object_data(op, mesh, data)
+    except Exception:
         if IS_2_79:
-            context.scene.objects.link(mesh)
-            mesh.select = True
-            context.scene.objects.active = mesh
+            context.scene.objects.unlink(mesh)
         else:
-            context.collection.objects.link(mesh)
-            mesh.select_set(True)
-            context.view_layer.objects.active = mesh
-        
-        
-        #Start import
-        
-        #Read geometry
-        vertices = [struct.unpack("<3f", file.read(12)) for _ in range(V)]
-        
-        morph_targets = [struct.unpack("<3f", file.read(12)) for _ in range(K)]
-        
-        tris = [struct.unpack("<3i", file.read(12)) for _ in range(T)]
-        quads = [struct.unpack("<4i", file.read(16)) for _ in range(Q)]
-        
-        #transfer to the mesh
-        mesh.data.from_pydata(vertices, [], tris + quads)
-        #in case of corrupt data, delete the mesh and cancel import
-        if mesh.data.validate():
-            if IS_2_79:
-                context.scene.objects.unlink(mesh)
-            else:
-                context.collection.objects.unlink(mesh)
-            context.blend_data.objects.remove(mesh)
-            context.blend_data.meshes.remove(mesh_data)
-            raise RuntimeError("Invalid mesh data; file is corrupt or in an unknown format")
-        
-        #discard vertex labels
-        for _ in range(LV):
-            skip_vertex_label(file)
-        
-        #discard surface point labels
-        for _ in range(LS):
-            skip_surface_label(file, ext & 2 == 2)
-        
-        #UVs
-        if ext & 1:
-            #Add UV map
-            if IS_2_79:
-                bpy.ops.mesh.uv_texture_add()
-            else:
-                mesh.data.uv_layers.new(do_init=False)
-            
-            if X == 0:
-                #UVs per vertex
-                uvs = [struct.unpack("<ff", file.read(8)) for _ in range(V)]
-                for loop in mesh.data.loops:
-                    mesh.data.uv_layers.active.data[loop.index].uv = uvs[loop.vertex_index]
-            else:
-                #UVs per face
-                uvs = [struct.unpack("<ff", file.read(8)) for _ in range(X)]
-                for i in range(T):
-                    set_face_uvs(mesh.data, mesh.data.polygons[i], struct.unpack("<3i", file.read(12)), uvs)
-                for i in range(T, T + Q):
-                    set_face_uvs(mesh.data, mesh.data.polygons[i], struct.unpack("<4i", file.read(16)), uvs)
-        
-        if Md > 0 or Ms > 0:
-            mesh.shape_key_add(name="Basis", from_mix=False)
-            
-        #Relative morphs
-        for _ in range(Md):
-            read_diff_morph(file, mesh)
-        
-        #Absolute morphs
-        K_pos = 0
-        for _ in range(Ms):
-            K_pos = read_stat_morph(file, mesh, morph_targets, K_pos)
-        assert(K_pos == len(morph_targets))
-        
-        
-        #Apply user transforms
-        mesh.matrix_world = bpy_extras.io_utils.axis_conversion(
-            from_forward=op.axis_forward, 
-            from_up=op.axis_up, 
-            to_forward='-Y', 
-            to_up='Z').to_4x4()
-        
-        mesh.scale = (1 / op.length_scale, 1 / op.length_scale, 1 / op.length_scale)
-        bpy.ops.object.transform_apply(rotation=True, scale=True)
+            context.collection.objects.unlink(mesh)
+        context.blend_data.objects.remove(mesh)
+        context.blend_data.meshes.remove(mesh_data)
+        raise
+    
+    op.report({'INFO'}, data.path + " imported successfully")
+    
+    return mesh
+
+
+def set_object_data(op, mesh, data):
+    """Transfer the geometry, UVs and morphs of a TriData to a new mesh object"""
+    
+    if not set_mesh_geometry(mesh.data, data.vertices, data.tris, data.quads) or mesh.data.validate():
+        raise RuntimeError("Invalid mesh data; file is corrupt or in an unknown format")
+    
+    #UVs
+    if data.uvs is not None:
+        #Add UV map
+        if IS_2_79:
+            bpy.ops.mesh.uv_texture_add()
+        else:
+            mesh.data.uv_layers.new(do_init=False)
         
-        op.report({'INFO'}, op.filepath + " imported successfully")
+        mesh.data.uv_layers.active.data.foreach_set("uv", data.uvs.ravel())
+    
+    #Morphs that were not asked for were never read from the file
+    imported_count = len(data.diff_morphs) + len(data.stat_morphs)
+    if imported_count < data.morph_count:
+        op.report({'INFO'}, "Imported %d of %d morphs" % (imported_count, data.morph_count))
+    
+    if imported_count > 0:
+        mesh.shape_key_add(name="Basis", from_mix=False)
+    
+    #Relative morphs
+    for name, co in data.diff_morphs:
+        add_morph(mesh, name, co)
+    
+    #Absolute morphs (these may be decoded lazily, so they can still turn out to be corrupt)
+    for name, co in data.stat_morphs:
+        add_morph(mesh, get_abs_morph_name(name), co)
+
+
+def update_object(op, context, data, mesh):
+    """Write the morphs of a TriData to the shape keys of an existing mesh object with the same vertices and faces"""
+    
+    if data.has_labels:
+        op.report({'WARNING'}, "Labels were discarded")
+    
+    #The morphs only make sense if the vertices are the same, in the same order
+    if len(mesh.data.vertices) != len(data.vertices):
+        raise RuntimeError("Mesh has %d vertices, the file has %d" % (len(mesh.data.vertices), len(data.vertices)))
+    
+    tri_loops, quad_loops = get_face_loops(
+        get_array(mesh.data.polygons, "loop_start", I32), get_array(mesh.data.polygons, "loop_total", I32))
+    loop_verts = get_array(mesh.data.loops, "vertex_index", I32)
+    if not (np.array_equal(loop_verts[tri_loops], data.tris) and np.array_equal(loop_verts[quad_loops], data.quads)):
+        raise RuntimeError("Mesh faces don't match those of the file")
+    
+    imported_count = len(data.diff_morphs) + len(data.stat_morphs)
+    if imported_count < data.morph_count:
+        op.report({'INFO'}, "Imported %d of %d morphs" % (imported_count, data.morph_count))
+    
+    if imported_count > 0 and mesh.data.shape_keys == None:
+        mesh.shape_key_add(name="Basis", from_mix=False)
+    
+    updated = 0
+    for name, co in data.diff_morphs:
+        updated += set_morph(mesh, name, co)
+    for name, co in data.stat_morphs:
+        updated += set_morph(mesh, get_abs_morph_name(name), co)
+    
+    op.report({'INFO'}, "%s: updated %d and added %d shape keys of %s" % (
+        data.path, updated, imported_count - updated, mesh.name))
+    
+    return mesh
+
+
+def get_face_loops(loop_start, loop_total):
+    """The loop indices of the tris and of the quads of a mesh, from the loop_start and loop_total of its polygons"""
+    if np.any((loop_total != 3) & (loop_total != 4)):
+        raise RuntimeError("Only tris and quads are supported")
+    
+    tri_loops = loop_start[loop_total == 3, None] + np.arange(3, dtype=I32)
+    quad_loops = loop_start[loop_total == 4, None] + np.arange(4, dtype=I32)
+    return tri_loops, quad_loops
+
+
+def get_export_filename(template, obj):
+    """The name of the file to export obj to, from a template like "{name}.tri"."""
+    try:
+        filename = template.format(name=obj.name, mesh=obj.data.name)
+    except (KeyError, IndexError, ValueError) as e:
+        raise RuntimeError("Invalid file name template \"%s\" (use {name} and {mesh}): %s" % (template, str(e)))
+    for c in '<>:"/\\|?*':
+        filename = filename.replace(c, "_")
+    return filename if filename.lower().endswith(".tri") else filename + ".tri"
+
+
+def get_export_matrix(op):
+    """The 3x3 matrix that transforms Blender coordinates to TRI coordinates"""
+    return np.array(bpy_extras.io_utils.axis_conversion(
+        from_forward='-Y', 
+        from_up='Z', 
+        to_forward=op.axis_forward, 
+        to_up=op.axis_up)) * op.length_scale
+
+
+def get_export_settings(op):
+    return ExportSettings(
+        uv_format=op.uv_format,
+        basis=get_export_matrix(op),
+        stat_morph_epsilon=op.stat_morph_epsilon,
+        use_cache=op.use_cache)
+
+
+def get_thread_count(op):
+    return op.threads if op.threads > 0 else os.cpu_count() or 1
+
+
+def get_import_matrix(op):
+    """The 3x3 matrix that transforms TRI coordinates to Blender coordinates"""
+    return bpy_extras.io_utils.axis_conversion(
+        from_forward=op.axis_forward, 
+        from_up=op.axis_up, 
+        to_forward='-Y', 
+        to_up='Z') * (1 / op.length_scale)
+
+
+def get_import_paths(op):
+    """The files to import: every TRI file in the directory, the selected files or the single filepath"""
+    directory = op.directory or os.path.dirname(op.filepath)
+    
+    if op.use_directory:
+        return [os.path.join(directory, f) for f in sorted(os.listdir(directory))
+            if f.lower().endswith(".tri") and os.path.isfile(os.path.join(directory, f))]
+    
+    files = [f.name for f in op.files if f.name]
+    if len(files) > 0:
+        return [os.path.join(directory, f) for f in files]
+    
+    return [op.filepath]
+
+
+def encode_abs_morph(label, co, ref_co, basis, epsilon):
+    """Returns the encoded stat morph and its (transformed) targets"""
+    vtx_ind = get_morphed_vertices(co, ref_co, epsilon)
+    return encode_stat_morph(label, vtx_ind), transform(co[vtx_ind], basis)
+
+
+def encode_rel_morph(label, co, ref_co, basis):
+    """Returns the encoded diff morph and whether it is empty"""
+    deltas = transform(co - ref_co, basis)
+    return encode_diff_morph(label, deltas), not deltas.any()
+
+
+def get_morphed_vertices(co, ref_co, epsilon):
+    """Indices of the vertices of an absolute morph. They are its targets."""
+    return np.flatnonzero(np.any(np.abs(co - ref_co) > epsilon, axis=1)).astype(I32)
 
 
 def get_abs_morph_name(name):
@@ -329,76 +680,59 @@ def is_abs_morph(shape):
     return shape.name[0] == "*"
 
 
-def pack_vector3(v):
-    return struct.pack("<3f", v[0], v[1], v[2])
+def get_array(collection, attr, dtype, width=1):
+    """Read an attribute of every item in a bpy collection into an array (of rows, if width > 1)"""
+    array = np.empty(len(collection) * width, dtype=dtype)
+    collection.foreach_get(attr, array)
+    return array.reshape(-1, width) if width > 1 else array
 
 
-def read_diff_morph(file, mesh):
-    label = read_morph_label(file)
-    shape = mesh.shape_key_add(name=label, from_mix=False)
-    
-    scale = struct.unpack("<f", file.read(4))[0]
-    
-    for i in range(len(mesh.data.vertices)):
-        dx, dy, dz = struct.unpack("<3h", file.read(6))
-        shape.data[i].co[0] += scale * dx
-        shape.data[i].co[1] += scale * dy
-        shape.data[i].co[2] += scale * dz
+def add_morph(mesh, name, co):
+    shape = mesh.shape_key_add(name=name, from_mix=False)
+    shape.data.foreach_set("co", co.ravel())
 
 
-def read_morph_label(file):
-    N = int.from_bytes(file.read(4), byteorder="little", signed=True)
-    return file.read(N).decode()
+def set_morph(mesh, name, co):
+    """Overwrite the shape key called name, or add it if there is none. Returns True if it was overwritten."""
+    shape = mesh.data.shape_keys.key_blocks.get(name)
+    if shape == None:
+        add_morph(mesh, name, co)
+        return False
+    
+    shape.data.foreach_set("co", co.ravel())
+    return True
 
 
-def read_stat_morph(file, mesh, morph_targets, K_pos):
-    label = read_morph_label(file)
-    shape = mesh.shape_key_add(name=get_abs_morph_name(label), from_mix=False)
+def set_mesh_geometry(mesh_data, vertices, tris, quads):
+    """Fill an empty mesh with vertices and faces. Returns False if any face refers to a nonexistent vertex."""
+    V = len(vertices)
+    T = len(tris)
+    Q = len(quads)
     
-    L = int.from_bytes(file.read(4), byteorder="little", signed=True)
+    face_verts = np.concatenate((tris.ravel(), quads.ravel()))
+    if len(face_verts) > 0 and (face_verts.min() < 0 or face_verts.max() >= V):
+        return False
     
-    #If I got this straight, these will be indices to our V geometry vertices,
-    #and their targets will be the positions from the list of morph_targets in order.
-    #So, we need to keep track of our accumulated position (hence the K_pos)
-    for i in range(L):
-        vtx_ind = int.from_bytes(file.read(4), byteorder="little", signed=True)
-        shape.data[vtx_ind].co = morph_targets[K_pos]
-        shape.data[vtx_ind].co[0] = morph_targets[K_pos][0]
-        shape.data[vtx_ind].co[1] = morph_targets[K_pos][1]
-        shape.data[vtx_ind].co[2] = morph_targets[K_pos][2]
-        K_pos += 1
+    loop_start = np.concatenate((np.arange(0, 3 * T, 3, dtype=I32), np.arange(3 * T, 3 * T + 4 * Q, 4, dtype=I32)))
     
-    return K_pos
-
-
-def set_face_uvs(mesh_data, face, indices, uv_list):
-    for i in range(len(indices)):
-        mesh_data.uv_layers.active.data[face.loop_indices[i]].uv = uv_list[indices[i]]
-
-
-def skip_surface_label(file, wchar):
-    #first a face index (?) and position
-    file.seek(16, 1)
-    #next is the length of the label string
-    S = int.from_bytes(file.read(4), byteorder="little", signed=True)
-    #then the string
-    if wchar:
-        file.seek(2 * S, 1)
-    else:
-        file.seek(S, 1)
+    mesh_data.vertices.add(V)
+    mesh_data.vertices.foreach_set("co", vertices.ravel())
     
-
-def skip_vertex_label(file):
-    #first a vertex index
-    file.seek(4, 1)
-    #next is the length of the label string
-    S = int.from_bytes(file.read(4), byteorder="little", signed=True)
-    #then the string
-    file.seek(S, 1)
+    mesh_data.loops.add(len(face_verts))
+    mesh_data.loops.foreach_set("vertex_index", face_verts)
+    
+    mesh_data.polygons.add(T + Q)
+    mesh_data.polygons.foreach_set("loop_start", loop_start)
+    if bpy.app.version < (4, 0, 0):
+        #Since 4.0, loop_total is read-only and follows from loop_start
+        loop_total = np.concatenate((np.full(T, 3, dtype=I32), np.full(Q, 4, dtype=I32)))
+        mesh_data.polygons.foreach_set("loop_total", loop_total)
+    
+    mesh_data.update(calc_edges=True)
+    return True
 
 
-def write_morph_label(file, shape):
-    label = get_shape_name(shape).encode() + b"\x00"
-    file.write(len(label).to_bytes(4, byteorder="little", signed=True))
-    file.write(label)
+def transform(co, matrix):
+    """Transform an array of coordinates by a 3x3 matrix"""
+    return (co @ matrix.T).astype(F32)
 
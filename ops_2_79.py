@@ -60,6 +60,38 @@ class TRIExport(TRIOperator, bpy_extras.io_utils.ExportHelper, TRIOrientationHel
         description="",
         default="UV_FACE")
     
+    stat_morph_epsilon = bpy.props.FloatProperty(
+        name="Absolute Morph Tolerance",
+        description="Vertices of absolute morphs that move less than this (in any direction) are not exported",
+        min=0.0,
+        default=0.0)
+    
+    use_cache = bpy.props.BoolProperty(
+        name="Reuse Unchanged Morphs",
+        description="Reuse the encoding of morphs that haven't changed since the object was last exported (not used with Low Memory)",
+        default=False)
+    
+    low_memory = bpy.props.BoolProperty(
+        name="Low Memory",
+        description="Read, encode and write one shape key at a time, to limit memory use when exporting dense meshes with many morphs (not used with Selected Objects)",
+        default=False)
+    
+    batch = bpy.props.BoolProperty(
+        name="Selected Objects",
+        description="Export every selected mesh to its own file, in the directory of the file path",
+        default=False)
+    
+    filename_template = bpy.props.StringProperty(
+        name="File Names",
+        description="Name of the file of each selected mesh. {name} is replaced by the name of the object, {mesh} by the name of its mesh",
+        default="{name}.tri")
+    
+    threads = bpy.props.IntProperty(
+        name="Threads",
+        description="Number of threads to encode meshes and morphs with (0: one per CPU)",
+        min=0,
+        default=0)
+    
     def invoke(self, context, event):
         obj = context.active_object
         
@@ -71,7 +103,12 @@ class TRIExport(TRIOperator, bpy_extras.io_utils.ExportHelper, TRIOrientationHel
         return bpy_extras.io_utils.ExportHelper.invoke(self, context, event)
     
     def execute_impl(self, context):
-        tri_tools.io.export_tri(self, context.active_object)
+        if self.batch:
+            tri_tools.io.export_tri_batch(self, context)
+        elif self.low_memory:
+            tri_tools.io.export_tri_streaming(self, context.active_object)
+        else:
+            tri_tools.io.export_tri(self, context.active_object)
 
 
 class TRIImport(TRIOperator, bpy_extras.io_utils.ImportHelper, TRIOrientationHelper):
@@ -91,12 +128,51 @@ class TRIImport(TRIOperator, bpy_extras.io_utils.ImportHelper, TRIOrientationHel
         description="Scale of imported model",
         default=10.0)
     
+    morph_filter = bpy.props.StringProperty(
+        name="Morphs",
+        description="Only import morphs matching these comma-separated names or patterns (* and ? are wildcards). Leave empty to import all morphs",
+        default="")
+    
+    files = bpy.props.CollectionProperty(
+        type=bpy.types.OperatorFileListElement,
+        options={'HIDDEN', 'SKIP_SAVE'})
+    
+    directory = bpy.props.StringProperty(
+        subtype='DIR_PATH',
+        options={'HIDDEN', 'SKIP_SAVE'})
+    
+    use_directory = bpy.props.BoolProperty(
+        name="Whole Directory",
+        description="Import every TRI file in the directory",
+        default=False)
+    
+    workers = bpy.props.IntProperty(
+        name="Workers",
+        description="Number of processes reading files when importing several files (0 for one per CPU)",
+        min=0,
+        default=0)
+    
+    low_memory = bpy.props.BoolProperty(
+        name="Low Memory",
+        description="Read one file and one morph at a time, to limit memory use when importing very large files",
+        default=False)
+    
+    use_cache = bpy.props.BoolProperty(
+        name="Use Cache",
+        description="Keep decoded files in a cache on disk, to speed up importing unchanged files again (not used with Low Memory)",
+        default=False)
+    
+    update_active = bpy.props.BoolProperty(
+        name="Update Active Object",
+        description="Write the morphs to the shape keys of the active object (which must have the same vertices and faces) instead of creating a new object",
+        default=False)
+    
     def execute_impl(self, context):
         tri_tools.io.import_tri(self, context)
 
 
 class TRITransferShapes(TRIOperator):
-    bl_description = "Transfer shape keys from selected to active object"
+    bl_description = "Transfer shape keys from selected to active object, or from active to selected objects"
     bl_idname = "object.tri_transfer_shapes"
     bl_label = "Transfer Shapes"
     bl_options = {'UNDO'}
@@ -109,6 +185,17 @@ class TRITransferShapes(TRIOperator):
         target = context.active_object
         if target == None or target.type != 'MESH':
             raise RuntimeError("No active mesh")
+        
+        if target.tri_transfer_shapes.mode == 'ACTIVE_TO_SELECTED':
+            #the active object is the source, every other selected mesh is a target (with the source's settings)
+            source = target
+            targets = [obj for obj in bpy.context.selected_objects if obj != source and obj.type == 'MESH']
+            if len(targets) == 0:
+                raise RuntimeError("No second selected mesh")
+            
+            tri_tools.transfer.transfer_shapes_multi(self, source, targets, source.tri_transfer_shapes, 
+                source.tri_transfer_shapes.force_full)
+            return
     
         source = None
 
@@ -119,7 +206,7 @@ class TRITransferShapes(TRIOperator):
         if source == None:
             raise RuntimeError("No second selected mesh")
         
-        tri_tools.transfer.transfer_shapes(self, source, target)
+        tri_tools.transfer.transfer_shapes(self, source, target, target.tri_transfer_shapes.force_full)
 
 def exportop(self, context):
     self.layout.operator(TRIExport.bl_idname, text="FaceGen TRI (.tri)")
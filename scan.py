@@ -0,0 +1,104 @@
+"""Inventory of TRI files, from their headers and morph labels only.
+
+Usage: python -m tri_tools.scan [-r REFERENCE | -v VERTICES] PATH...
+"""
+
+#Copyright 2022 Jonas Gernandt
+#
+#This file is part of TRI Tools, a Blender addon for working with 
+#Skyrim face morphs.
+#
+#TRI Tools is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#TRI Tools is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with TRI Tools. If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import collections
+import os
+import sys
+
+from tri_tools.trifile import TriFile
+
+#Summary of a TRI file. error is None if the file could be read, else the other fields are None.
+TriInfo = collections.namedtuple("TriInfo", ["path", "V", "T", "Q", "X", "diff_morphs", "stat_morphs", "error"])
+
+
+def scan_tri(path):
+    """Read the counts and morph names of a TRI file. Vertex, face and morph data is never read."""
+    try:
+        with TriFile(path) as tri:
+            return TriInfo(path, tri.V, tri.T, tri.Q, tri.X,
+                [m.name for m in tri.diff_morphs], [m.name for m in tri.stat_morphs], None)
+    except (OSError, RuntimeError) as e:
+        return TriInfo(path, None, None, None, None, None, None, str(e))
+
+
+def find_tri_files(paths):
+    """Yield the TRI files in paths, recursing into directories"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for f in sorted(files):
+                    if f.lower().endswith(".tri"):
+                        yield os.path.join(root, f)
+        else:
+            yield path
+
+
+def scan(paths):
+    """Yield a TriInfo for every TRI file in paths"""
+    for path in find_tri_files(paths):
+        yield scan_tri(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="tri_tools.scan", description="List the contents of TRI files.")
+    parser.add_argument("paths", nargs="+", metavar="PATH", help="TRI file or directory to scan recursively")
+    parser.add_argument("-n", "--names", action="store_true", help="list morph names")
+    reference = parser.add_mutually_exclusive_group()
+    reference.add_argument("-r", "--reference", metavar="TRI", help="flag files whose vertex count differs from this TRI file")
+    reference.add_argument("-v", "--vertices", type=int, metavar="V", help="flag files whose vertex count is not V")
+    args = parser.parse_args(argv)
+    
+    expected = args.vertices
+    if args.reference:
+        ref = scan_tri(args.reference)
+        if ref.error:
+            parser.error("%s: %s" % (args.reference, ref.error))
+        expected = ref.V
+    
+    problems = 0
+    for info in scan(args.paths):
+        if info.error:
+            print("%s: ERROR %s" % (info.path, info.error))
+            problems += 1
+            continue
+        
+        line = "%s: V=%d T=%d Q=%d X=%d diff=%d stat=%d" % (
+            info.path, info.V, info.T, info.Q, info.X, len(info.diff_morphs), len(info.stat_morphs))
+        if expected is not None and info.V != expected:
+            line += " MISMATCH (expected V=%d)" % expected
+            problems += 1
+        print(line)
+        
+        if args.names:
+            for name in info.diff_morphs:
+                print("    " + name)
+            for name in info.stat_morphs:
+                print("    *" + name)
+    
+    return 1 if problems > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
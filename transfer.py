@@ -16,65 +16,399 @@
 #You should have received a copy of the GNU General Public License
 #along with TRI Tools. If not, see <https://www.gnu.org/licenses/>.
 
-import math
+import collections
+import os
 
 import bpy
 import mathutils
+import mathutils.bvhtree
+import numpy as np
 
+import tri_tools.cache
+from tri_tools.io import get_array
+from tri_tools.trifile import CHUNK_SIZE, F32, I32
 
-def target_diff(d, diffs, indices, weights, falloff):
-    result = sum([diffs[indices[i]] * weights[i] for i in range(len(indices))], mathutils.Vector())
-    result *= math.exp(-falloff * d)
-    return result
+#How source deltas map to target deltas. Each target vertex gets the sum of the deltas of the
+#corners (indices) of the source polygon closest to it, times their weights (interpolation
+#weights times distance falloff). Rows are padded with zero weights to the largest polygon.
+Binding = collections.namedtuple("Binding", ["indices", "weights", "distances"])
 
-def transfer_shapes(operator, source, target):
+#ID property of a target object where we record, by source object and shape, a hash of what each shape was transferred from
+RECORD = "tri_transfer_shapes_record"
+
+#Distance from a corner or an edge within which a point is considered to be on it (as Blender does)
+EPSILON = 1e-5
+
+#Smallest (twice) area of the triangle between a point and an edge for which we trust its angle
+AREA_EPSILON = np.finfo(np.float32).eps
+
+
+def transfer_shapes(operator, source, target, force=False):
     """Transfer all shape keys in source mesh to target mesh, as determined from the closest point"""
+    transfer_shapes_multi(operator, source, [target], target.tri_transfer_shapes, force)
+
+
+def transfer_shapes_multi(operator, source, targets, props, force=False):
+    """Transfer all shape keys in source mesh to every target mesh, with the settings props (a TRITransferShapesProps).
+    
+    What is needed of the source is read once, then each target is bound and its shape keys written.
+    Shapes that are unchanged since they were last transferred to a target are skipped, unless force."""
+    src = get_source_mesh(source)
     if source.data.shape_keys != None:
+        names, digests, deltas = get_shape_deltas(source)
+    else:
+        #Nothing to transfer, but the shape keys we made before must still be removed
+        names, digests, deltas = [], [], None
+    
+    for target in targets:
+        record = get_record(target, source.name)
+        if len(names) == 0 and not any(record.values()):
+            continue
         
         #Warn about different world space transforms
         if source.matrix_world != target.matrix_world:
-            operator.report({'WARNING'}, "World-space transforms are not accounted for")
-
-        if target.data.shape_keys == None:
-            target.shape_key_add(name="Basis", from_mix=False)
-        
-        #gather distance info and interpolation parameters (will be the same for all shapes)
-        distances = [0.0] * len(target.data.vertices)
-        indices = [[]] * len(target.data.vertices)
-        weights = [[]] * len(target.data.vertices)
-        for v in target.data.vertices:
-            result, location, _, index = source.closest_point_on_mesh(v.co)
-            if result:
-                src_verts = [source.data.vertices[source.data.loops[i].vertex_index]
-                    for i in source.data.polygons[index].loop_indices]
-                
-                distances[v.index] = (v.co - location).length
-                indices[v.index] = [vtx.index for vtx in src_verts]
-                weights[v.index] = mathutils.interpolate.poly_3d_calc([mathutils.Vector(vtx.co) for vtx in src_verts], location)
-
-        for src_shape in source.data.shape_keys.key_blocks:
-            ref = source.data.shape_keys.reference_key
-            if src_shape == ref:
+            operator.report({'WARNING'}, "%s: World-space transforms are not accounted for" % target.name)
+        
+        tgt_co = get_array(target.data.vertices, "co", F32, 3)
+        key = get_binding_key(src, tgt_co, props.distance_falloff, props.max_distance)
+        
+        #A shape is the same as last time if its deltas and the binding are
+        hashes = [tri_tools.cache.content_hash(key, digest).hex() for digest in digests]
+        keys = record["keys"]
+        #(and its shape key is still there)
+        key_blocks = target.data.shape_keys.key_blocks if target.data.shape_keys != None else {}
+        if force:
+            todo = list(range(len(names)))
+        else:
+            todo = [i for i, name in enumerate(names) 
+                if record["written"].get(name, record["empty"].get(name)) != hashes[i]
+                    or (name in record["written"] and keys.get(name, name) not in key_blocks)]
+        
+        #No need for a binding if nothing changed
+        written = set()
+        made = {}
+        if len(todo) > 0:
+            #the binding is the same for all shapes
+            binding = get_binding(src, tgt_co, props.distance_falloff, props.max_distance, key)
+            written, made = set_shapes(target, tgt_co, binding, [names[i] for i in todo], deltas[todo], props.replace, keys)
+        
+        #Remove the shape keys we made from shapes that are gone from the source (or are empty now)
+        gone = set(keys) - set(names)
+        gone.update(names[i] for i in todo if names[i] not in written)
+        if target.data.shape_keys != None:
+            for name in gone:
+                if name in keys and keys[name] in target.data.shape_keys.key_blocks:
+                    target.shape_key_remove(target.data.shape_keys.key_blocks[keys[name]])
+        
+        #Record what each shape key was made from, and the names of the keys we made
+        new_record = {"written": {}, "empty": {}, "keys": {}}
+        todo = set(todo)
+        for i, name in enumerate(names):
+            if i in todo:
+                new_record["written" if name in written else "empty"][name] = hashes[i]
+                if name in made:
+                    new_record["keys"][name] = made[name]
+            else:
+                new_record["written" if name in record["written"] else "empty"][name] = hashes[i]
+                if name in keys:
+                    new_record["keys"][name] = keys[name]
+        set_record(target, source.name, new_record)
+        
+        if len(todo) < len(names):
+            operator.report({'INFO'}, "%s: %d of %d shapes unchanged" % (target.name, len(names) - len(todo), len(names)))
+
+
+def set_shapes(target, tgt_co, binding, names, deltas, replace=True, keys=None):
+    """Add (or replace) the shape keys of target from the deltas of the source shapes.
+    
+    keys are the names of the shape keys we made from them before, by shape name. These are updated. Else, 
+    with Replace, a shape key of the same name is overwritten (but it is still not ours), or a new one added.
+    Returns the names of the shapes that were not empty, and the names of the shape keys we made, by shape name."""
+    written = set()
+    made = {}
+    if keys is None:
+        keys = {}
+    
+    if target.data.shape_keys == None:
+        target.shape_key_add(name="Basis", from_mix=False)
+    
+    #transfer a chunk of shapes at a time, to bound the size of the arrays
+    step = max(1, CHUNK_SIZE * 16 // max(len(tgt_co), deltas.shape[1], 1))
+    for start in range(0, len(names), step):
+        tgt_deltas = apply_binding(binding, deltas[start:start + step])
+        
+        for name, tgt_diff in zip(names[start:start + step], tgt_deltas):
+            #filter out empty morphs
+            if not tgt_diff.any():
                 continue
             
-            #calc the difference vectors of the source shape
-            src_diff = [src_shape.data[i].co - ref.data[i].co for i in range(len(source.data.vertices))]
-            
-            #calc the corresponding difference vectors of the target shape
-            tgt_diff = [target_diff(distances[i], src_diff, indices[i], weights[i], target.tri_transfer_shapes.distance_falloff) 
-                for i in range(len(target.data.vertices))]
+            key_blocks = target.data.shape_keys.key_blocks
+            if name in keys and keys[name] in key_blocks:
+                tgt_shape = key_blocks[keys[name]]
+                made[name] = tgt_shape.name
+            elif replace and name in key_blocks:
+                tgt_shape = key_blocks[name]
+            else:
+                #the new key may get another name, if there is one with this name already
+                tgt_shape = target.shape_key_add(name=name, from_mix=False)
+                made[name] = tgt_shape.name
             
-            #filter out empty morphs
-            null = mathutils.Vector()
-            for d in tgt_diff:
-                if d != null:
-                    #not empty, add this shape key
-                    if target.tri_transfer_shapes.replace and src_shape.name in target.data.shape_keys.key_blocks:
-                        tgt_shape = target.data.shape_keys.key_blocks[src_shape.name]
-                    else:
-                        tgt_shape = target.shape_key_add(name=src_shape.name, from_mix=False)
-    
-                    for i in range(len(target.data.vertices)):
-                        tgt_shape.data[i].co = target.data.vertices[i].co + tgt_diff[i]
-                    
-                    break
+            tgt_shape.data.foreach_set("co", (tgt_co + tgt_diff).astype(F32).ravel())
+            written.add(name)
+    
+    return written, made
+
+
+def get_record(target, source_name):
+    """The hashes of the shapes last transferred from source to target, by shape name. "written" are those 
+    that were written to a shape key, "empty" those that had no effect on target. "keys" are the names of 
+    the shape keys we made (not those we only overwrote), which are the only ones we may remove."""
+    record = target.get(RECORD, {}).get(source_name)
+    record = record.to_dict() if record is not None else {}
+    return {"written": record.get("written", {}), "empty": record.get("empty", {}), "keys": record.get("keys", {})}
+
+
+def set_record(target, source_name, hashes):
+    record = target.get(RECORD)
+    record = record.to_dict() if record is not None else {}
+    record[source_name] = hashes
+    target[RECORD] = record
+
+
+class SourceMesh:
+    """What we need of a source mesh to bind targets to it: its base vertices, the padded corners of its polygons 
+    and their counts, and a hash of them.
+    
+    Its BVHTree (and the polygon of each of its triangles, unless they are the polygons) is only built on 
+    first access, since the bindings often come from the cache. Access it from the main thread."""
+    
+    def __init__(self, mesh_data):
+        self.co = get_array(mesh_data.vertices, "co", F32, 3).astype(np.float64)
+        self.corners, self.counts = get_polygon_corners(mesh_data)
+        self.key = tri_tools.cache.content_hash(self.co, self.corners, self.counts)
+        
+        self._mesh_data = mesh_data
+        self._bvh = None
+    
+    @property
+    def bvh(self):
+        return self._get_bvh()[0]
+    
+    @property
+    def tri_polygons(self):
+        return self._get_bvh()[1]
+    
+    def _get_bvh(self):
+        if self._bvh is None:
+            self._bvh = get_bvh(self._mesh_data, self.co, self.corners, self.counts)
+        return self._bvh
+
+
+def get_source_mesh(source):
+    """Read the base geometry of source (its spatial index is built when needed)"""
+    return SourceMesh(source.data)
+
+
+def get_binding_key(src, tgt_co, falloff, max_distance=0.0):
+    """A hash of everything the binding of target vertices tgt_co to the SourceMesh src depends on.
+    Shape keys can change freely."""
+    return tri_tools.cache.content_hash("binding", src.key, tgt_co, np.array([falloff, max_distance]))
+
+
+def get_binding(src, tgt_co, falloff, max_distance=0.0, key=None, directory=tri_tools.cache.DEFAULT_DIRECTORY):
+    """Like bind, but reuses the binding from an earlier transfer between the same geometry, with the same settings.
+    key is their get_binding_key, if the caller already has it."""
+    if key is None:
+        key = get_binding_key(src, tgt_co, falloff, max_distance)
+    entry = os.path.join(directory, key.hex() + tri_tools.cache.FILE_EXT)
+    
+    loaded = tri_tools.cache.load_arrays(entry)
+    if loaded is not None and all(name in loaded[1] for name in Binding._fields):
+        return Binding(**loaded[1])
+    
+    binding = bind(src, tgt_co, falloff, max_distance)
+    try:
+        tri_tools.cache.store_arrays(entry, {}, list(zip(Binding._fields, binding)))
+        tri_tools.cache.evict(directory)
+    except OSError:
+        #caching is an optimisation, don't fail the transfer because of it
+        pass
+    
+    return binding
+
+
+def bind(src, tgt_co, falloff, max_distance=0.0):
+    """Find the closest point on the SourceMesh src to each of the target vertices tgt_co, and make a Binding of it.
+    
+    Vertices farther than max_distance from source (if it is not 0) are left unbound."""
+    V = len(tgt_co)
+    indices = np.zeros((V, src.corners.shape[1]), dtype=I32)
+    weights = np.zeros(indices.shape)
+    distances = np.zeros(V)
+    
+    if src.bvh is None:
+        return Binding(indices, weights, distances)
+    
+    args = (max_distance,) if max_distance > 0.0 else ()
+    
+    #query a chunk of vertices at a time, then compute their weights all at once
+    for start in range(0, V, CHUNK_SIZE):
+        hits = [src.bvh.find_nearest(co, *args) for co in tgt_co[start:start + CHUNK_SIZE].tolist()]
+        hits = [(start + i, hit) for i, hit in enumerate(hits) if hit[2] is not None]
+        if len(hits) == 0:
+            continue
+        
+        rows = np.array([i for i, _ in hits], dtype=np.intp)
+        locations = np.array([tuple(hit[0]) for _, hit in hits])
+        polygons = np.array([hit[2] for _, hit in hits], dtype=np.intp)
+        if src.tri_polygons is not None:
+            polygons = src.tri_polygons[polygons]
+        
+        corners = src.corners[polygons]
+        distances[rows] = [hit[3] for _, hit in hits]
+        indices[rows] = corners
+        weights[rows] = get_weights(locations, src.co[corners], src.counts[polygons])
+    
+    weights *= np.exp(-falloff * distances)[:, None]
+    
+    return Binding(indices, weights, distances)
+
+
+def get_bvh(mesh_data, co, corners, counts):
+    """A BVHTree of a mesh (None if it has no polygons), and the polygon of each of its triangles (None if they 
+    are the polygons).
+    
+    We use the mesh's own triangulation if there is one, to find the same points as closest_point_on_mesh."""
+    if len(corners) == 0:
+        return None, None
+    
+    if hasattr(mesh_data, "loop_triangles"):
+        mesh_data.calc_loop_triangles()
+        tris = get_array(mesh_data.loop_triangles, "vertices", I32, 3)
+        return (mathutils.bvhtree.BVHTree.FromPolygons(co.tolist(), tris.tolist(), all_triangles=True),
+            get_array(mesh_data.loop_triangles, "polygon_index", I32))
+    
+    return mathutils.bvhtree.BVHTree.FromPolygons(co.tolist(),
+        [c[:n] for c, n in zip(corners.tolist(), counts.tolist())]), None
+
+
+def get_polygon_corners(mesh_data):
+    """The vertex indices of the corners of every polygon, padded with 0 to the largest polygon, and their counts"""
+    loop_start = get_array(mesh_data.polygons, "loop_start", I32)
+    loop_total = get_array(mesh_data.polygons, "loop_total", I32)
+    loop_verts = get_array(mesh_data.loops, "vertex_index", I32)
+    
+    width = int(loop_total.max()) if len(loop_total) > 0 else 1
+    cols = np.arange(width)
+    valid = cols < loop_total[:, None]
+    
+    corners = np.zeros((len(loop_total), width), dtype=I32)
+    corners[valid] = loop_verts[(loop_start[:, None] + cols)[valid]]
+    return corners, loop_total
+
+
+def get_weights(points, corners, counts):
+    """The interpolation weights of the corners of polygons at points on them, like poly_3d_calc does it: 
+    barycentric for triangles, mean value for larger polygons.
+    
+    points is (M, 3), corners is (M, W, 3) and padded beyond counts (M)."""
+    M, W = corners.shape[:2]
+    rows = np.arange(M)[:, None]
+    cols = np.arange(W)
+    valid = cols < counts[:, None]
+    
+    #the next and previous corner of each corner
+    next = np.where(cols + 1 < counts[:, None], cols + 1, 0)
+    prev = np.where(cols > 0, cols - 1, counts[:, None] - 1)
+    
+    d = corners - points[:, None]
+    length = np.sqrt((d * d).sum(axis=2))
+    d_next = d[rows, next]
+    length_next = length[rows, next]
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        #Mean value coordinates, from the tangents of the half angles between corners
+        area = np.sqrt((np.cross(d, d_next) ** 2).sum(axis=2))
+        half_tan = np.where(area > AREA_EPSILON, (length * length_next - (d * d_next).sum(axis=2)) / area, 0.0)
+        weights = np.where(valid, (half_tan[rows, prev] + half_tan) / length, 0.0)
+        total = weights.sum(axis=1, keepdims=True)
+        weights = np.where(total != 0.0, weights / total, weights)
+        
+        #Points on an edge are interpolated between its ends
+        edge = d_next - d
+        edge_sq = (edge * edge).sum(axis=2)
+        fac = np.clip(np.where(edge_sq > 0.0, -(d * edge).sum(axis=2) / edge_sq, 0.0), 0.0, 1.0)
+        to_edge = d + fac[:, :, None] * edge
+        on_edge = valid & ((to_edge * to_edge).sum(axis=2) < EPSILON * EPSILON)
+        
+        edge_rows = np.flatnonzero(on_edge.any(axis=1))
+        i = on_edge[edge_rows].argmax(axis=1)
+        weights[edge_rows] = 0.0
+        weights[edge_rows, i] = 1.0 - fac[edge_rows, i]
+        weights[edge_rows, next[edge_rows, i]] = fac[edge_rows, i]
+        
+        #Points on a corner take all of its weight
+        at_corner = valid & (length < EPSILON)
+        
+        corner_rows = np.flatnonzero(at_corner.any(axis=1))
+        weights[corner_rows] = 0.0
+        weights[corner_rows, at_corner[corner_rows].argmax(axis=1)] = 1.0
+        
+        #Barycentric coordinates of points in (non-degenerate) triangles
+        tris = np.flatnonzero(counts == 3)
+        v0 = corners[tris, 1] - corners[tris, 0]
+        v1 = corners[tris, 2] - corners[tris, 0]
+        v2 = points[tris] - corners[tris, 0]
+        d00 = (v0 * v0).sum(axis=1)
+        d01 = (v0 * v1).sum(axis=1)
+        d11 = (v1 * v1).sum(axis=1)
+        d20 = (v2 * v0).sum(axis=1)
+        d21 = (v2 * v1).sum(axis=1)
+        denom = d00 * d11 - d01 * d01
+        
+        ok = denom > AREA_EPSILON * AREA_EPSILON * d00 * d11
+        tris = tris[ok]
+        b = (d11 * d20 - d01 * d21)[ok] / denom[ok]
+        c = (d00 * d21 - d01 * d20)[ok] / denom[ok]
+        weights[tris, 0] = 1.0 - b - c
+        weights[tris, 1] = b
+        weights[tris, 2] = c
+    
+    return weights
+
+
+def apply_binding(binding, deltas):
+    """Map an (S, source V, 3) array of deltas to an (S, target V, 3) array"""
+    S, V = deltas.shape[:2]
+    
+    #with the deltas of all shapes of a vertex in one row, each corner is one gather of whole rows
+    rows = deltas.transpose(1, 0, 2).reshape(V, S * 3)
+    result = np.zeros((len(binding.indices), S * 3))
+    for k in range(binding.indices.shape[1]):
+        result += binding.weights[:, k, None] * rows[binding.indices[:, k]]
+    
+    return result.reshape(-1, S, 3).transpose(1, 0, 2)
+
+
+def get_shape_deltas(source):
+    """The names, content hashes and stacked (S, V, 3) deltas of the shape keys of source, but for empty ones"""
+    ref = source.data.shape_keys.reference_key
+    ref_co = get_array(ref.data, "co", F32, 3)
+    
+    names = []
+    digests = []
+    shapes = []
+    for src_shape in source.data.shape_keys.key_blocks:
+        if src_shape == ref:
+            continue
+        
+        co = get_array(src_shape.data, "co", F32, 3)
+        digest = tri_tools.cache.content_hash(ref_co, co)
+        if np.any(co != ref_co):
+            names.append(src_shape.name)
+            digests.append(digest)
+            shapes.append(co)
+    
+    deltas = np.array(shapes, dtype=F32).reshape(-1, len(ref_co), 3)
+    deltas -= ref_co
+    return names, digests, deltas
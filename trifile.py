@@ -0,0 +1,453 @@
+"""Random access to the contents of a TRI file, without Blender dependencies"""
+
+#Copyright 2022 Jonas Gernandt
+#
+#This file is part of TRI Tools, a Blender addon for working with 
+#Skyrim face morphs.
+#
+#TRI Tools is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#TRI Tools is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with TRI Tools. If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import fnmatch
+import functools
+import mmap
+import struct
+
+import numpy as np
+
+SIGNATURE = b"FRTRI003"
+
+HEADER = struct.Struct("<8s10i16s")
+
+#Element types of the binary data
+F32 = np.dtype("<f4")
+I16 = np.dtype("<i2")
+I32 = np.dtype("<i4")
+
+#Number of vertices decoded at a time, to bound the size of temporary arrays
+CHUNK_SIZE = 65536
+
+#Location of a morph in the file. offset is the start of the payload, following the label.
+#For diff morphs, count is V. For stat morphs, count is the number of vertex indices and
+#target is the position of the first of their targets in the list of morph targets.
+MorphInfo = collections.namedtuple("MorphInfo", ["name", "offset", "count", "target"])
+
+#Decoded contents of a TRI file, independent of the file. uvs are in loop order (or None),
+#diff_morphs and stat_morphs are lists of (name, absolute vertex positions).
+TriData = collections.namedtuple("TriData",
+    ["path", "vertices", "tris", "quads", "uvs", "diff_morphs", "stat_morphs", "morph_count", "has_labels"])
+
+
+def parse_patterns(text):
+    """Split a comma-separated list of morph names or glob patterns"""
+    return [p.strip() for p in text.split(",") if p.strip()]
+
+
+def match_patterns(name, patterns):
+    """True if name matches any of the patterns, or if there are no patterns"""
+    return not patterns or any(fnmatch.fnmatchcase(name, p) for p in patterns)
+
+
+def encode_label(name):
+    """Encode a length-prefixed, null-terminated string"""
+    label = name.encode() + b"\x00"
+    return struct.pack("<i", len(label)) + label
+
+
+def encode_diff_morph(name, deltas):
+    """Encode a diff morph from its (V, 3) array of deltas"""
+    scale, quantized = quantize_deltas(deltas)
+    return encode_label(name) + struct.pack("<f", scale) + quantized.tobytes()
+
+
+def quantize_deltas(deltas, scratch=None, out=None):
+    """Returns the scale and the short int deltas of a diff morph, from its (V, 3) array of deltas.
+    
+    To avoid allocating, pass a float64 scratch array and a short int out array of the same shape."""
+    #choose the scale so that the largest component in any delta vector equals the largest short int
+    delta_max = max(float(deltas.max()), -float(deltas.min())) if len(deltas) > 0 else 0.0
+    scale = delta_max / 32767 if delta_max > 0.0 else 1.0
+    
+    scratch = np.divide(deltas, scale, out=scratch, dtype=np.float64)
+    np.round(scratch, out=scratch)
+    
+    if out is None:
+        return scale, scratch.astype(I16)
+    np.copyto(out, scratch, casting='unsafe')
+    return scale, out
+
+
+def encode_stat_morph(name, indices):
+    """Encode a stat morph from the indices of its vertices (their targets are stored separately)"""
+    return encode_label(name) + struct.pack("<i", len(indices)) + np.asarray(indices, dtype=I32).tobytes()
+
+
+class TriFile:
+    """A memory-mapped TRI file.
+    
+    The header and morph labels are parsed on opening. Everything else is read on first access,
+    as arrays that refer directly to the mapped file. They are only valid until the file is closed."""
+    
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            #empty file
+            self._file.close()
+            raise RuntimeError("Not a FaceGen TRI file")
+        
+        try:
+            self._index()
+        except:
+            self.close()
+            raise
+        
+        self._vertices = None
+        self._morph_targets = None
+        self._tris = None
+        self._quads = None
+        self._uvs = None
+        self._uv_tris = None
+        self._uv_quads = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            #there are arrays still referring to the map, it will be released with them
+            pass
+        self._file.close()
+    
+    @property
+    def has_uvs(self):
+        return self.ext & 1 == 1
+    
+    @property
+    def has_face_uvs(self):
+        return self.has_uvs and self.X > 0
+    
+    @property
+    def vertices(self):
+        if self._vertices is None:
+            self._vertices = self._array(F32, self.V, 3, self.vertex_offset)
+        return self._vertices
+    
+    @property
+    def morph_targets(self):
+        if self._morph_targets is None:
+            self._morph_targets = self._array(F32, self.K, 3, self.morph_target_offset)
+        return self._morph_targets
+    
+    @property
+    def tris(self):
+        if self._tris is None:
+            self._tris = self._array(I32, self.T, 3, self.tri_offset)
+        return self._tris
+    
+    @property
+    def quads(self):
+        if self._quads is None:
+            self._quads = self._array(I32, self.Q, 4, self.quad_offset)
+        return self._quads
+    
+    @property
+    def uvs(self):
+        """UV coordinates, per vertex or per face index. None if the file has no UVs."""
+        if self._uvs is None and self.has_uvs:
+            self._uvs = self._array(F32, self.X if self.X > 0 else self.V, 2, self.uv_offset)
+        return self._uvs
+    
+    @property
+    def uv_tris(self):
+        """Indices into uvs for each tri. None unless UVs are per face."""
+        if self._uv_tris is None and self.has_face_uvs:
+            self._uv_tris = self._array(I32, self.T, 3, self.uv_face_offset)
+        return self._uv_tris
+    
+    @property
+    def uv_quads(self):
+        """Indices into uvs for each quad. None unless UVs are per face."""
+        if self._uv_quads is None and self.has_face_uvs:
+            self._uv_quads = self._array(I32, self.Q, 4, self.uv_face_offset + 12 * self.T)
+        return self._uv_quads
+    
+    def diff_morph(self, i):
+        """Returns the scale and the (V, 3) array of quantized deltas of diff morph i"""
+        info = self.diff_morphs[i]
+        scale = struct.unpack_from("<f", self._map, info.offset)[0]
+        return scale, self._array(I16, info.count, 3, info.offset + 4)
+    
+    def stat_morph(self, i):
+        """Returns the vertex indices and their target positions of stat morph i"""
+        info = self.stat_morphs[i]
+        indices = self._array(I32, info.count, 1, info.offset + 4).ravel()
+        return indices, self.morph_targets[info.target:info.target + info.count]
+    
+    def diff_morph_positions(self, i, basis, matrix=None, out=None):
+        """Returns the vertex positions of diff morph i applied to basis.
+        
+        If given, the 3x3 matrix transforms the deltas (basis should already be transformed).
+        The result is written to out, if given, a chunk of vertices at a time."""
+        scale, deltas = self.diff_morph(i)
+        if out is None:
+            out = np.empty(basis.shape, dtype=F32)
+        if matrix is not None:
+            matrix = (scale * matrix).T
+        
+        for start in range(0, len(basis), CHUNK_SIZE):
+            chunk = slice(start, start + CHUNK_SIZE)
+            if matrix is None:
+                out[chunk] = basis[chunk] + scale * deltas[chunk]
+            else:
+                out[chunk] = basis[chunk] + deltas[chunk] @ matrix
+        return out
+    
+    def stat_morph_positions(self, i, basis, matrix=None, out=None):
+        """Returns the vertex positions of stat morph i applied to basis.
+        
+        If given, the 3x3 matrix transforms the targets (basis should already be transformed).
+        The result is written to out, if given."""
+        #If I got this straight, these will be indices to our V geometry vertices,
+        #and their targets will be the positions from the list of morph_targets in order.
+        indices, targets = self.stat_morph(i)
+        if len(indices) > 0 and (indices.min() < 0 or indices.max() >= len(basis)):
+            raise RuntimeError("Invalid morph data; file is corrupt or in an unknown format")
+        
+        if out is None:
+            out = np.empty(basis.shape, dtype=F32)
+        out[:] = basis
+        out[indices] = targets if matrix is None else targets @ matrix.T
+        return out
+    
+    def transformed_vertices(self, matrix=None):
+        """Returns a copy of the vertices, transformed by the 3x3 matrix if given"""
+        if matrix is None:
+            return np.array(self.vertices)
+        else:
+            return (self.vertices @ matrix.T).astype(F32)
+    
+    def loop_uvs(self):
+        """Returns the UV coordinates of every face corner, in order, or None if the file has no UVs"""
+        if not self.has_uvs:
+            return None
+        
+        #UV indices in loop order, per vertex or per face
+        if not self.has_face_uvs:
+            indices = np.concatenate((self.tris.ravel(), self.quads.ravel()))
+        else:
+            indices = np.concatenate((self.uv_tris.ravel(), self.uv_quads.ravel()))
+        
+        if len(indices) > 0 and (indices.min() < 0 or indices.max() >= len(self.uvs)):
+            raise RuntimeError("Invalid UV data; file is corrupt or in an unknown format")
+        
+        return self.uvs[indices]
+    
+    def _array(self, dtype, count, width, offset):
+        return np.frombuffer(self._map, dtype=dtype, count=count * width, offset=offset).reshape(count, width)
+    
+    def _int(self, offset):
+        self._require(offset, 4)
+        return struct.unpack_from("<i", self._map, offset)[0]
+    
+    def _require(self, offset, size):
+        if size < 0 or offset + size > len(self._map):
+            raise RuntimeError("Unexpected end of file")
+    
+    def _label(self, offset):
+        """Returns a length-prefixed string and the offset following it"""
+        N = self._int(offset)
+        self._require(offset + 4, N)
+        try:
+            return self._map[offset + 4:offset + 4 + N].rstrip(b"\x00").decode(), offset + 4 + N
+        except UnicodeDecodeError:
+            raise RuntimeError("Invalid morph name; file is corrupt or in an unknown format")
+    
+    def _index(self):
+        self._require(0, HEADER.size)
+        signature, V, T, Q, LV, LS, X, ext, Md, Ms, K, _ = HEADER.unpack_from(self._map, 0)
+        if signature != SIGNATURE:
+            raise RuntimeError("Not a FaceGen TRI file")
+        if min(V, T, Q, LV, LS, X, Md, Ms, K) < 0:
+            raise RuntimeError("Invalid header; file is corrupt or in an unknown format")
+        
+        self.V, self.T, self.Q, self.LV, self.LS, self.X, self.ext, self.Md, self.Ms, self.K = \
+            V, T, Q, LV, LS, X, ext, Md, Ms, K
+        
+        offset = HEADER.size
+        self.vertex_offset = offset
+        offset += 12 * V
+        self.morph_target_offset = offset
+        offset += 12 * K
+        self.tri_offset = offset
+        offset += 12 * T
+        self.quad_offset = offset
+        offset += 16 * Q
+        self._require(0, offset)
+        
+        #vertex labels: a vertex index followed by a string
+        self.vertex_label_offset = offset
+        #(skipped without decoding, we don't use them)
+        for _ in range(LV):
+            N = self._int(offset + 4)
+            self._require(offset + 8, N)
+            offset += 8 + N
+        
+        #surface point labels: a face index and a position, followed by a (possibly wide) string
+        self.surface_label_offset = offset
+        wchar = ext & 2 == 2
+        for _ in range(LS):
+            S = self._int(offset + 16)
+            offset += 20 + (2 * S if wchar else S)
+        self._require(0, offset)
+        
+        self.uv_offset = offset
+        self.uv_face_offset = offset
+        if ext & 1:
+            offset += 8 * (X if X > 0 else V)
+            self.uv_face_offset = offset
+            if X > 0:
+                offset += 12 * T + 16 * Q
+        self._require(0, offset)
+        
+        #diff morphs are a label, a scale and V quantized deltas
+        self.diff_morph_offset = offset
+        self.diff_morphs = []
+        for _ in range(Md):
+            name, offset = self._label(offset)
+            self.diff_morphs.append(MorphInfo(name, offset, V, 0))
+            offset += 4 + 6 * V
+            self._require(0, offset)
+        
+        #stat morphs are a label, a count L and L vertex indices, with targets in the list of morph targets
+        self.stat_morph_offset = offset
+        self.stat_morphs = []
+        target = 0
+        for _ in range(Ms):
+            name, offset = self._label(offset)
+            L = self._int(offset)
+            if L < 0 or target + L > K:
+                raise RuntimeError("Invalid morph data; file is corrupt or in an unknown format")
+            self.stat_morphs.append(MorphInfo(name, offset, L, target))
+            offset += 4 + 4 * L
+            target += L
+            self._require(0, offset)
+        if target != K:
+            raise RuntimeError("Invalid morph data; file is corrupt or in an unknown format")
+        
+        self.size = offset
+
+
+def decode_tri(path, patterns=(), matrix=None):
+    """Decode a TRI file into a TriData, including only the morphs matching patterns.
+    
+    If given, all coordinates are transformed by the 3x3 matrix (a nested sequence).
+    This is safe to call from a process that doesn't have Blender."""
+    if matrix is not None:
+        matrix = np.array(matrix, dtype=np.float64)
+    
+    with TriFile(path) as tri:
+        vertices = tri.transformed_vertices(matrix)
+        
+        diff_morphs = []
+        for i, info in enumerate(tri.diff_morphs):
+            if match_patterns(info.name, patterns):
+                diff_morphs.append((info.name, tri.diff_morph_positions(i, vertices, matrix)))
+        
+        stat_morphs = []
+        for i, info in enumerate(tri.stat_morphs):
+            if match_patterns(info.name, patterns):
+                stat_morphs.append((info.name, tri.stat_morph_positions(i, vertices, matrix)))
+        
+        return TriData(
+            path=path,
+            vertices=vertices,
+            tris=np.array(tri.tris),
+            quads=np.array(tri.quads),
+            uvs=tri.loop_uvs(),
+            diff_morphs=diff_morphs,
+            stat_morphs=stat_morphs,
+            morph_count=tri.Md + tri.Ms,
+            has_labels=tri.LV > 0 or tri.LS > 0)
+
+
+class TriStream:
+    """Iterates over TRI files like map(decode_tri, paths), but reads morphs lazily.
+    
+    Only one file is open at a time. Its morphs are decoded one at a time as they are iterated,
+    into the same buffer. Each TriData is only valid until the next one is requested."""
+    
+    def __init__(self, paths, patterns=(), matrix=None):
+        self._paths = iter(paths)
+        self._patterns = patterns
+        self._matrix = None if matrix is None else np.array(matrix, dtype=np.float64)
+        self._tri = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        self.close()
+        
+        path = next(self._paths)
+        tri = self._tri = TriFile(path)
+        
+        vertices = tri.transformed_vertices(self._matrix)
+        buffer = np.empty(vertices.shape, dtype=F32)
+        
+        return TriData(
+            path=path,
+            vertices=vertices,
+            tris=tri.tris,
+            quads=tri.quads,
+            uvs=tri.loop_uvs(),
+            diff_morphs=MorphStream(tri.diff_morphs, self._patterns,
+                functools.partial(tri.diff_morph_positions, basis=vertices, matrix=self._matrix, out=buffer)),
+            stat_morphs=MorphStream(tri.stat_morphs, self._patterns,
+                functools.partial(tri.stat_morph_positions, basis=vertices, matrix=self._matrix, out=buffer)),
+            morph_count=tri.Md + tri.Ms,
+            has_labels=tri.LV > 0 or tri.LS > 0)
+    
+    def close(self):
+        if self._tri is not None:
+            self._tri.close()
+            self._tri = None
+
+
+class MorphStream:
+    """The morphs matching patterns, as (name, positions) decoded by decode(index) on iteration"""
+    
+    def __init__(self, morphs, patterns, decode):
+        self._morphs = [(i, info.name) for i, info in enumerate(morphs) if match_patterns(info.name, patterns)]
+        self._decode = decode
+    
+    def __len__(self):
+        return len(self._morphs)
+    
+    def __iter__(self):
+        for i, name in self._morphs:
+            yield name, self._decode(i)
@@ -20,9 +20,20 @@ import bpy
 
 
 class TRITransferShapesProps(bpy.types.PropertyGroup):
+    mode: bpy.props.EnumProperty(name="Mode", default='SELECTED_TO_ACTIVE',
+        items=[('SELECTED_TO_ACTIVE', "Selected to Active", "Transfer from a selected mesh to the active one"),
+            ('ACTIVE_TO_SELECTED', "Active to Selected", "Transfer from the active mesh to every selected one")],
+        description="Which object is the source and which the target")
+    
     distance_falloff: bpy.props.FloatProperty(name="Distance Falloff", min=0.0, default=0.0,
         description="Decrease the influence of the shape by distance from the source mesh")
     
+    max_distance: bpy.props.FloatProperty(name="Max Distance", min=0.0, default=0.0,
+        description="Leave target vertices farther than this from the source mesh unaffected (0: no limit)")
+    
+    force_full: bpy.props.BoolProperty(name="Force Full", default=False,
+        description="Transfer every shape, also those that haven't changed since they were last transferred")
+    
     replace: bpy.props.BoolProperty(name="Replace", default=True,
         description="Replace existing shape keys if names are identical")
 
@@ -43,8 +54,11 @@ class TRITransferShapesPanel(bpy.types.Panel):
         
         if obj:
             self.layout.operator("object.tri_transfer_shapes", icon='SHAPEKEY_DATA')
+            self.layout.prop(obj.tri_transfer_shapes, "mode")
             self.layout.prop(obj.tri_transfer_shapes, "distance_falloff")
+            self.layout.prop(obj.tri_transfer_shapes, "max_distance")
             self.layout.prop(obj.tri_transfer_shapes, "replace")
+            self.layout.prop(obj.tri_transfer_shapes, "force_full")
 
 
 def register():